@@ -1,12 +1,21 @@
 import timeit
+import os
 import random
 from typing import List
 import statistics
 import sys
 from pathlib import Path
-from termynus import evaluate as zig_evaluate
 from service.term_interpreter import evaluate_str as py_evaluate
 
+# The Zig extension is built against the CPython C API; under PyPy only the Python implementation is benchmarked
+try:
+    from termynus import evaluate as zig_evaluate
+except ImportError:
+    zig_evaluate = None
+
+# PyPy's JIT needs a few hundred passes over the expressions before the evaluator loop is traced
+WARMUP_RUNS = 1000 if sys.implementation.name == "pypy" else 1
+
 # Add the project root to Python path
 sys.path.append(str(Path(__file__).parent.parent))
 
@@ -55,9 +64,8 @@ def get_test_expressions() -> List[str]:
     ]
 
 
-def benchmark_implementation(name: str, evaluate_func, expressions: List[str], iterations: int = 10000):
-    """Benchmark a specific implementation."""
-    times = []
+def benchmark_implementation(name: str, evaluate_func, expressions: List[str], repeat: int = 100, number: int = 100):
+    """Benchmark a specific implementation, reporting the time per pass over all expressions."""
 
     def run_evaluate():
         for expr in expressions:
@@ -66,20 +74,20 @@ def benchmark_implementation(name: str, evaluate_func, expressions: List[str], i
             except Exception as e:
                 print(f"Error evaluating {expr}: {e}")
 
-    # Warm-up run
-    run_evaluate()
+    # Warm-up runs
+    for _ in range(WARMUP_RUNS):
+        run_evaluate()
 
-    # Actual timing
-    for _ in range(iterations):
-        time = timeit.timeit(run_evaluate, number=1)
-        times.append(time)
+    # Actual timing: each sample runs `number` passes under one timer (timeit disables GC while timing)
+    timer = timeit.Timer(run_evaluate)
+    times = [sample / number for sample in timer.repeat(repeat=repeat, number=number)]
 
     avg_time = statistics.mean(times)
     median_time = statistics.median(times)
     std_dev = statistics.stdev(times)
 
     print(f"\n{name} Results:")
-    print(f"total time: {sum(times):.6f} seconds")
+    print(f"total time: {sum(times) * number:.6f} seconds")
     print(f"Average time: {avg_time:.6f} seconds")
     print(f"Median time: {median_time:.6f} seconds")
     print(f"Std Dev: {std_dev:.6f} seconds")
@@ -89,7 +97,15 @@ def benchmark_implementation(name: str, evaluate_func, expressions: List[str], i
     return {"avg": avg_time, "median": median_time, "std_dev": std_dev, "min": min(times), "max": max(times)}
 
 
+def pin_to_single_cpu():
+    """Keep the benchmark on one CPU to avoid migration noise, where the platform supports it."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+
+
 def main():
+    pin_to_single_cpu()
+
     # Get test expressions
     print("Loading test expressions...")
     expressions = get_test_expressions()
@@ -103,6 +119,9 @@ def main():
 
     # Benchmark both implementations
     py_results = benchmark_implementation("Python Implementation", py_evaluate, expressions)
+    if zig_evaluate is None:
+        print("\nZig extension not available, skipping comparison.")
+        return
     zig_results = benchmark_implementation("Zig Implementation", zig_evaluate, expressions)
 
     # Compare results
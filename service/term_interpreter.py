@@ -3,6 +3,9 @@ import operator
 import re
 import statistics
 import datetime
+from collections import ChainMap, namedtuple
+from functools import lru_cache, partial
+from itertools import islice
 
 
 unary_operators = {
@@ -288,57 +291,414 @@ builtin_env = {
 
 import service.term_parser as term_parser
 
+# Compact nodes walked by the evaluator. Parse trees are dicts; they are lowered
+# to these once, resolving operator callables so evaluation never looks them up by name.
+BinOp = namedtuple("BinOp", "fn left right")
+And = namedtuple("And", "left right")  # short-circuit: right is only evaluated when left is truthy
+Or = namedtuple("Or", "left right")  # short-circuit: right is only evaluated when left is falsy
+UnaryOp = namedtuple("UnaryOp", "fn arg")
+FunCall = namedtuple("FunCall", "name args")
+BuiltinCall = namedtuple("BuiltinCall", "fn args")
+ListNode = namedtuple("ListNode", "elements")
+Lit = namedtuple("Lit", "value")
+Id = namedtuple("Id", "name")
+
+
+def lit_value(value):
+    # Parsed trees carry final literal values; strings only come from hand-built trees
+    if isinstance(value, str):
+        lowered = value.lower()
+        if lowered == "true":
+            return 1
+        if lowered == "false":
+            return 0
+        if (value[0] == '"' or value[0] == "'") and (value[-1] == '"' or value[-1] == "'"):
+            return value[1:-1]  # for strings
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)  # assuming all other lits are float
+    return value
+
+
+def is_constant(node):
+    # literals of immutable types; their operator results can be shared between evaluations
+    return type(node) is Lit and isinstance(node.value, (int, float, str, datetime.date))
+
+
+# Operators whose result can grow far beyond their operands are left for evaluation
+unfolded_operators = frozenset((operator.pow, operator.lshift))
+
+
+def fold_constant(fn, *args):
+    # Operators applied to constants are computed once while lowering.
+    # Errors such as division by zero are left for evaluation to raise.
+    if fn in unfolded_operators:
+        return None
+    values = [arg.value for arg in args]
+    if fn is operator.mul and any(isinstance(value, str) for value in values):
+        return None  # string repetition
+    try:
+        return Lit(fn(*values))
+    except (ArithmeticError, ValueError, TypeError):
+        return None
+
+
+def lower(ast):
+    node_type = ast["type"]
+    if node_type == "bin_op" and ast["name"] in ("and", "or"):
+        left = lower(ast["args"][0])
+        if type(left) is Lit:
+            # a constant left side decides the result or hands it to the right side,
+            # which is not lowered when it can never run
+            if left.value if ast["name"] == "or" else not left.value:
+                return left
+            return lower(ast["args"][1])
+        right = lower(ast["args"][1])
+        return And(left, right) if ast["name"] == "and" else Or(left, right)
+    elif node_type == "bin_op":
+        fn = binary_operators[ast["name"]]
+        left = lower(ast["args"][0])
+        right = lower(ast["args"][1])
+        if is_constant(left) and is_constant(right):
+            return fold_constant(fn, left, right) or BinOp(fn, left, right)
+        return BinOp(fn, left, right)
+    elif node_type == "unary_op":
+        fn = unary_operators[ast["name"]]
+        arg = lower(ast["args"][0])
+        if is_constant(arg):
+            return fold_constant(fn, arg) or UnaryOp(fn, arg)
+        return UnaryOp(fn, arg)
+    elif node_type == "fun":
+        args = tuple(lower(arg) for arg in ast["args"])
+        # builtin functions are bound here; only user functions are looked up in env
+        if ast["name"] in builtin_env:
+            return BuiltinCall(builtin_env[ast["name"]], args)
+        return FunCall(ast["name"], args)
+    elif node_type == "list":
+        return ListNode(tuple(lower(element) for element in ast["elements"]))
+    elif node_type == "lit":
+        return Lit(lit_value(ast["value"]))
+    elif node_type in ("lit_int", "lit_float", "lit_bool"):
+        return Lit(ast["value"])
+    elif node_type == "lit_str":
+        if not isinstance(ast["value"], str):
+            raise ValueError(f"Not a valid string literal: {ast['value']}")
+        return Lit(ast["value"])
+    elif node_type == "lit_date":
+        return Lit(ast["value"])
+    elif node_type == "id":
+        return Id(ast["value"])
+    else:
+        raise ValueError(f"Unknown AST node type: {node_type}")
+
+
+# Opcodes of the flat bytecode the lowered nodes are compiled to. Each
+# instruction is an (opcode, operand) pair; operands hold values and resolved
+# callables directly.
+LOAD_CONST = 0
+LOAD_ID = 1
+BINARY_OP = 2
+UNARY_OP = 3
+CALL_BUILTIN = 4  # operand: (fn, argc)
+CALL = 5  # operand: (name, argc)
+BUILD_LIST = 6  # operand: element count
+# Short-circuit jumps. When taken they keep the deciding value on the stack and skip
+# the next `operand` instructions; otherwise the value is popped.
+JUMP_IF_FALSE_OR_POP = 7
+JUMP_IF_TRUE_OR_POP = 8
+
+
+def emit(node, code):
+    node_type = type(node)
+    if node_type is BinOp:
+        emit(node.left, code)
+        emit(node.right, code)
+        code.append((BINARY_OP, node.fn))
+    elif node_type is Lit:
+        code.append((LOAD_CONST, node.value))
+    elif node_type is Id:
+        code.append((LOAD_ID, node.name))
+    elif node_type is UnaryOp:
+        emit(node.arg, code)
+        code.append((UNARY_OP, node.fn))
+    elif node_type is BuiltinCall:
+        for arg in node.args:
+            emit(arg, code)
+        code.append((CALL_BUILTIN, (node.fn, len(node.args))))
+    elif node_type is FunCall:
+        for arg in node.args:
+            emit(arg, code)
+        code.append((CALL, (node.name, len(node.args))))
+    elif node_type is And or node_type is Or:
+        emit(node.left, code)
+        jump = len(code)
+        code.append(None)
+        emit(node.right, code)
+        code[jump] = (JUMP_IF_FALSE_OR_POP if node_type is And else JUMP_IF_TRUE_OR_POP, len(code) - jump - 1)
+    elif node_type is ListNode:
+        for element in node.elements:
+            emit(element, code)
+        code.append((BUILD_LIST, len(node.elements)))
+    else:
+        raise ValueError(f"Unknown node: {node!r}")
+    return code
+
+
+def compile_to_bytecode(node):
+    return tuple(emit(node, []))
+
+
+def compile_ast(ast):
+    # dict parse tree -> bytecode, in one step
+    return compile_to_bytecode(lower(ast))
+
+
+# Operators that are rendered with Python syntax by to_python; all other callables are called by reference
+infix_syntax = {
+    operator.add: "+",
+    operator.sub: "-",
+    operator.mul: "*",
+    operator.truediv: "/",
+    operator.floordiv: "//",
+    operator.pow: "**",
+    operator.mod: "%",
+    operator.lt: "<",
+    operator.le: "<=",
+    operator.gt: ">",
+    operator.ge: ">=",
+    operator.eq: "==",
+    operator.ne: "!=",
+    operator.or_: "|",
+    operator.and_: "&",
+    operator.xor: "^",
+    operator.lshift: "<<",
+    operator.rshift: ">>",
+}
+
+prefix_syntax = {
+    operator.not_: "not ",
+    operator.inv: "~",
+    operator.neg: "-",
+}
+
+
+def reference(value, constants):
+    constants.append(value)
+    return f"_k{len(constants) - 1}"
+
+
+def count_identifiers(node, counts):
+    node_type = type(node)
+    if node_type is Id:
+        counts[node.name] = counts.get(node.name, 0) + 1
+    elif node_type is BinOp or node_type is And or node_type is Or:
+        count_identifiers(node.left, counts)
+        count_identifiers(node.right, counts)
+    elif node_type is UnaryOp:
+        count_identifiers(node.arg, counts)
+    elif node_type is BuiltinCall or node_type is FunCall:
+        for arg in node.args:
+            count_identifiers(arg, counts)
+    elif node_type is ListNode:
+        for element in node.elements:
+            count_identifiers(element, counts)
+
+
+def to_python(node, constants, local_names, loaded, conditional=False):
+    # Renders a lowered node as a fully parenthesized Python expression over `env`, in evaluation order.
+    # Literal values and callables are not written out; they are referenced as _k<i> names.
+    # An identifier in `local_names` is stored into its local at the first read made on every evaluation
+    # (recorded in `loaded`); reads after that use the local, reads before it still go to env.
+    node_type = type(node)
+    if node_type is BinOp:
+        left = to_python(node.left, constants, local_names, loaded, conditional)
+        right = to_python(node.right, constants, local_names, loaded, conditional)
+        if node.fn in infix_syntax:
+            return f"({left} {infix_syntax[node.fn]} {right})"
+        return f"{reference(node.fn, constants)}({left}, {right})"
+    elif node_type is Lit:
+        return reference(node.value, constants)
+    elif node_type is Id:
+        if node.name in loaded:
+            return local_names[node.name]
+        if node.name in local_names and not conditional:
+            loaded.add(node.name)
+            return f"({local_names[node.name]} := env[{node.name!r}])"
+        return f"env[{node.name!r}]"
+    elif node_type is UnaryOp:
+        arg = to_python(node.arg, constants, local_names, loaded, conditional)
+        if node.fn in prefix_syntax:
+            return f"({prefix_syntax[node.fn]}{arg})"
+        return f"{reference(node.fn, constants)}({arg})"
+    elif node_type is BuiltinCall or node_type is FunCall:
+        args = ", ".join(to_python(arg, constants, local_names, loaded, conditional) for arg in node.args)
+        if node_type is FunCall:
+            # the arguments are evaluated before the function is looked up, as in the VM
+            return f"{reference(call_function, constants)}(env, {node.name!r}{', ' if args else ''}{args})"
+        return f"{reference(node.fn, constants)}({args})"
+    elif node_type is And or node_type is Or:
+        operator_name = "and" if node_type is And else "or"
+        left = to_python(node.left, constants, local_names, loaded, conditional)
+        right = to_python(node.right, constants, local_names, loaded, True)
+        return f"({left} {operator_name} {right})"
+    elif node_type is ListNode:
+        elements = ", ".join(
+            to_python(element, constants, local_names, loaded, conditional) for element in node.elements
+        )
+        return f"[{elements}]"
+    else:
+        raise ValueError(f"Unknown node: {node!r}")
+
+
+def call_function(env, name, *args):
+    return env[name](*args)
+
+
+def missing_identifier(error, env, names):
+    # a KeyError for an identifier of the expression that env does not bind is reported like LOAD_ID does
+    key = error.args[0] if error.args else None
+    if key in names and key not in env:
+        return NameError(f"Undefined identifier: {key}")
+    return error
+
+
+def compile_to_function(node):
+    # Compiles a lowered node to a Python function of env, so evaluation runs as CPython bytecode.
+    # Expressions nested too deeply for the Python compiler run on the VM instead.
+    counts = {}
+    count_identifiers(node, counts)
+    # identifiers read more than once are looked up in env a single time and kept in a local;
+    # env is still read where the VM reads it first, so errors surface in the same order
+    local_names = {name: f"_v{i}" for i, name in enumerate(name for name in counts if counts[name] > 1)}
+    constants = []
+    body = to_python(node, constants, local_names, set())
+    parameters = "".join(f", _k{i}=_k{i}" for i in range(len(constants)))
+    source = (
+        f"def run(env{parameters}, _names=_names, missing_identifier=missing_identifier):\n"
+        f"    try:\n"
+        f"        return {body}\n"
+        f"    except KeyError as error:\n"
+        f"        raise missing_identifier(error, env, _names) from None\n"
+    )
+    namespace = {f"_k{i}": value for i, value in enumerate(constants)}
+    namespace["_names"] = tuple(counts)
+    namespace["missing_identifier"] = missing_identifier
+    try:
+        exec(compile(source, "<term>", "exec"), namespace)
+    except (SyntaxError, RecursionError):
+        return partial(execute, compile_to_bytecode(node))
+    return namespace["run"]
+
+
+@lru_cache(maxsize=1024)
+def compile_str_to_function(expression):
+    return compile_to_function(lower(term_parser.parse_to_tree(expression)))
+
+
+# Bytecode of trees passed to evaluate, keyed by tree identity. Trees are treated as read-only, like the
+# ones parse_to_tree returns; each entry keeps its tree alive so the id cannot be taken by another object.
+compiled_trees = {}
+
+
+def compile_tree(ast):
+    entry = compiled_trees.get(id(ast))
+    if entry is None:
+        if len(compiled_trees) >= 1024:
+            del compiled_trees[next(iter(compiled_trees))]
+        entry = compiled_trees[id(ast)] = (ast, compile_ast(ast))
+    return entry[1]
+
+
+def clear_eval_cache():
+    # drops compiled programs and the parse trees they were built from
+    compiled_trees.clear()
+    compile_str_to_function.cache_clear()
+    term_parser.parse_to_tree.cache_clear()
+
+
+def with_builtins(env):
+    # builtin constants (pi, e, ...) are visible unless the caller shadows them;
+    # without caller bindings the builtin table is used as is
+    if not env:
+        return builtin_env
+    return ChainMap(env, builtin_env)
+
 
 def evaluate_str(expression, env=None):
-    ast = term_parser.parse_to_tree(expression)
-    return evaluate(ast, env, join_builtin=False)
+    return compile_str_to_function(expression)(with_builtins(env))
 
 
 def evaluate(ast, env=None, join_builtin=True):
-    if env is None:
-        env = {}
-    # join with builtin env
     if join_builtin:
-        env = {**builtin_env, **env}
-
-    if ast["type"] == "bin_op":
-        left_val = evaluate(ast["args"][0], env, join_builtin=False)
-        right_val = evaluate(ast["args"][1], env, join_builtin=False)
-        return binary_operators[ast["name"]](left_val, right_val)
-    elif ast["type"] == "unary_op":
-        val = evaluate(ast["args"][0], env, join_builtin=False)
-        return unary_operators[ast["name"]](val)
-    elif ast["type"] == "fun":
-        args = [evaluate(arg, env, join_builtin=False) for arg in ast["args"]]
-        return env[ast["name"]](*args)
-    elif ast["type"] == "list":
-        return [evaluate(element, env, join_builtin=False) for element in ast["elements"]]
-    elif ast["type"] == "lit":
-        if isinstance(ast["value"], str):
-            if ast["value"].lower() == "true":
-                return 1
-            if ast["value"].lower() == "false":
-                return 0
-            if (ast["value"][0] == '"' or ast["value"][0] == "'") and (
-                ast["value"][-1] == '"' or ast["value"][-1] == "'"
-            ):
-                return ast["value"][1:-1]  # for strings
-            return float(ast["value"])  # assuming all lits are float otherwise
-        else:
-            return ast["value"]
-    elif ast["type"] == "lit_str":
-        if not isinstance(ast["value"], str):
-            raise ValueError(f"Not a valid string literal: {ast['value']}")
-        else:
-            return ast["value"]
-    elif ast["type"] == "lit_date":
-        return ast["value"]
-
-    elif ast["type"] == "id":
-        identifier = ast["value"]
-        if identifier in env:
-            return env[identifier]
-        else:
-            raise NameError(f"Undefined identifier: {identifier}")
-    else:
-        raise ValueError(f"Unknown AST node type: {ast['type']}")
+        env = with_builtins(env)
+    elif env is None:
+        env = {}
+    return execute(compile_tree(ast), env)
+
+
+# Module globals used in the loop are bound as defaults so they are read as fast locals
+def execute(
+    code,
+    env,
+    LOAD_CONST=LOAD_CONST,
+    LOAD_ID=LOAD_ID,
+    BINARY_OP=BINARY_OP,
+    UNARY_OP=UNARY_OP,
+    CALL_BUILTIN=CALL_BUILTIN,
+    CALL=CALL,
+    BUILD_LIST=BUILD_LIST,
+    JUMP_IF_FALSE_OR_POP=JUMP_IF_FALSE_OR_POP,
+    JUMP_IF_TRUE_OR_POP=JUMP_IF_TRUE_OR_POP,
+    islice=islice,
+):
+    stack = []
+    instructions = iter(code)
+    for op, arg in instructions:
+        if op == LOAD_CONST:
+            stack.append(arg)
+        elif op == BINARY_OP:
+            right = stack.pop()
+            stack[-1] = arg(stack[-1], right)
+        elif op == LOAD_ID:
+            try:
+                stack.append(env[arg])
+            except KeyError:
+                raise NameError(f"Undefined identifier: {arg}") from None
+        elif op == UNARY_OP:
+            stack[-1] = arg(stack[-1])
+        elif op == CALL_BUILTIN or op == CALL:
+            fn, argc = arg
+            if op == CALL:
+                fn = env[fn]
+            if argc:
+                args = stack[-argc:]
+                del stack[-argc:]
+                stack.append(fn(*args))
+            else:
+                stack.append(fn())
+        elif op == BUILD_LIST:
+            if arg:
+                elements = stack[-arg:]
+                del stack[-arg:]
+                stack.append(elements)
+            else:
+                stack.append([])
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[-1]:
+                stack.pop()
+            else:
+                next(islice(instructions, arg, arg), None)
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1]:
+                next(islice(instructions, arg, arg), None)
+            else:
+                stack.pop()
+    return stack[-1]
+
+
+# Use the compiled loop from term_interpreter_cy.pyx when it has been built
+try:
+    from service.term_interpreter_cy import execute  # noqa: F811
+except ImportError:
+    pass
@@ -0,0 +1,71 @@
+# cython: language_level=3
+# Optional compiled replacement for term_interpreter.execute.
+# Build in place with: cythonize -i service/term_interpreter_cy.pyx
+cimport cython
+
+# Must match the opcode values in term_interpreter.py
+cdef enum:
+    LOAD_CONST = 0
+    LOAD_ID = 1
+    BINARY_OP = 2
+    UNARY_OP = 3
+    CALL_BUILTIN = 4
+    CALL = 5
+    BUILD_LIST = 6
+    JUMP_IF_FALSE_OR_POP = 7
+    JUMP_IF_TRUE_OR_POP = 8
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef object execute(tuple code, object env):
+    cdef list stack = []
+    cdef tuple instruction
+    cdef int op
+    cdef Py_ssize_t ip = 0, n = len(code)
+    cdef Py_ssize_t top, argc
+    cdef object arg, fn, right
+    while ip < n:
+        instruction = code[ip]
+        ip += 1
+        op = instruction[0]
+        arg = instruction[1]
+        if op == LOAD_CONST:
+            stack.append(arg)
+        elif op == BINARY_OP:
+            right = stack.pop()
+            top = len(stack) - 1
+            stack[top] = arg(stack[top], right)
+        elif op == LOAD_ID:
+            try:
+                stack.append(env[arg])
+            except KeyError:
+                raise NameError(f"Undefined identifier: {arg}") from None
+        elif op == UNARY_OP:
+            top = len(stack) - 1
+            stack[top] = arg(stack[top])
+        elif op == CALL_BUILTIN or op == CALL:
+            fn, argc = arg
+            if op == CALL:
+                fn = env[fn]
+            top = len(stack) - argc
+            args = stack[top:]
+            del stack[top:]
+            stack.append(fn(*args))
+        elif op == BUILD_LIST:
+            argc = arg
+            top = len(stack) - argc
+            elements = stack[top:]
+            del stack[top:]
+            stack.append(elements)
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[len(stack) - 1]:
+                stack.pop()
+            else:
+                ip += <Py_ssize_t>arg
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[len(stack) - 1]:
+                ip += <Py_ssize_t>arg
+            else:
+                stack.pop()
+    return stack[len(stack) - 1]
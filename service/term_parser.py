@@ -1,134 +1,111 @@
 import re
 from datetime import datetime
+from functools import lru_cache
 
-# Define the regex pattern for tokens
+# Define the regex pattern for tokens. The trailing \S alternative turns any
+# character the other alternatives do not cover into its own token, so the
+# parser rejects it instead of the tokenizer silently skipping it.
 token_regex = re.compile(
-    r'\s*(=>|//|\*\*|==|!=|<=|>=|<<|>>|\|{1,2}|&|\^|d"(?:\\.|[^"\\])*"|d\'(?:\\.|[^\'\\])*\'|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|-\d*\.\d+|-\.\d+|-\d+\b|\$[\w\.]+|\b[\w\.]+\b|\d+\.\d+|\.\d+|\d+\b|[+\-*/%(),<>!=])\s*'
+    r'\s*(=>|//|\*\*|==|!=|<=|>=|<<|>>|\|{1,2}|&|\^|d"(?:\\.|[^"\\])*"|d\'(?:\\.|[^\'\\])*\'|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|-\d*\.\d+|-\.\d+|-\d+\b|\$[\w\.]+|\b[\w\.]+\b|\d+\.\d+|\.\d+|\d+\b|[+\-*/%(),<>!=]|\S)\s*'
 )
 
 
-iso_date_regex = re.compile(r"^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}(.\d+)?(Z|(\+|-)\d{2}:\d{2})?)?$")
-
-
-# Define unary and binary operators, precedence, and associativity in Python dictionaries
-unary_operators = {"not", "neg", "floor", "ceil", "abs", "int", "float", "bool"}
-binary_operators = {
-    "+",
-    "-",
-    "*",
-    "/",
-    "//",
-    "**",
-    "mod",
-    "%",
-    "<",
-    "<=",
-    ">",
-    ">=",
-    "==",
-    "!=",
-    "and",
-    "or",
-    "|",
-    "&",
-    "xor",
-    "<<",
-    ">>",
+number_regex = re.compile(r"^-?\d+(\.\d+)?$")
+identifier_regex = re.compile(r"^[a-zA-Z_][\w\.]*$")
+function_regex = re.compile(r"^\$[a-zA-Z_][\w\.]*$")
+escape_regex = re.compile(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)", re.DOTALL)
+escape_sequences = {
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "v": "\v",
+    '"': '"',
+    "'": "'",
+    "\\": "\\",
 }
 
-precedence = {
-    "or": 1,
-    "and": 2,
-    "|": 3,
-    "xor": 3,
-    "&": 3,
-    "==": 4,
-    "!=": 4,
-    "<": 5,
-    ">": 5,
-    "<=": 5,
-    ">=": 5,
-    "+": 6,
-    "-": 6,
-    "*": 7,
-    "/": 7,
-    "//": 7,
-    "mod": 7,
-    "%": 7,
-    "<<": 8,
-    ">>": 8,
-    "**": 9,
-    "not": 10,
-    "neg": 6,
-    "floor": 10,
-    "ceil": 10,
-    "abs": 10,
-    "int": 10,
-    "float": 10,
-    "bool": 10,
-    "function": 20,
+# Boolean literals, evaluated as integers like the interpreter does for "lit" nodes
+boolean_literals = {"true": 1, "false": 0}
+
+
+# Operator table: name -> (precedence, associativity, arity). One lookup gives
+# the parser everything it needs about a token.
+operator_info = {
+    "or": (1, "L", 2),
+    "and": (2, "L", 2),
+    "|": (3, "L", 2),
+    "xor": (3, "L", 2),
+    "&": (3, "L", 2),
+    "==": (4, "L", 2),
+    "!=": (4, "L", 2),
+    "<": (5, "L", 2),
+    ">": (5, "L", 2),
+    "<=": (5, "L", 2),
+    ">=": (5, "L", 2),
+    "+": (6, "L", 2),
+    "-": (6, "L", 2),
+    "*": (7, "L", 2),
+    "/": (7, "L", 2),
+    "//": (7, "L", 2),
+    "mod": (7, "L", 2),
+    "%": (7, "L", 2),
+    "<<": (8, "L", 2),
+    ">>": (8, "L", 2),
+    "**": (9, "R", 2),  # exponentiation is right-associative
+    "not": (10, "R", 1),
+    "neg": (6, "R", 1),
+    "floor": (10, "R", 1),
+    "ceil": (10, "R", 1),
+    "abs": (10, "R", 1),
+    "int": (10, "R", 1),
+    "float": (10, "R", 1),
+    "bool": (10, "R", 1),
 }
+function_precedence = 20
 
-associativity = {
-    "or": "L",
-    "and": "L",
-    "|": "L",
-    "xor": "L",
-    "&": "L",
-    "==": "L",
-    "!=": "L",
-    "<": "L",
-    ">": "L",
-    "<=": "L",
-    ">=": "L",
-    "+": "L",
-    "-": "L",
-    "*": "L",
-    "/": "L",
-    "//": "L",
-    "mod": "L",
-    "%": "L",
-    "<<": "L",
-    ">>": "L",
-    "**": "R",  # exponentiation is right-associative
-    "not": "R",
-    "floor": "R",
-    "ceil": "R",
-    "abs": "R",
-    "int": "R",
-    "float": "R",
-    "bool": "R",
-}
+unary_operators = frozenset(name for name, info in operator_info.items() if info[2] == 1)
+binary_operators = frozenset(name for name, info in operator_info.items() if info[2] == 2)
+# a tuple, not a set: operator stack entries can be (unhashable) dicts
+open_brackets = ("(", "[")
 
 
 def get_stack_precedence(stack):
     top = stack[-1]
     if top["type"] == "fun":
-        return precedence["function"]
-    return precedence[top["name"]]
+        return function_precedence
+    return operator_info[top["name"]][0]
 
 
 def get_precedence(token):
-    # print("get_precedence",token)
-    return precedence[token]
+    return operator_info[token][0]
 
 
 # Tokenizing function
 def tokenize(expression):
-    tokens = token_regex.split(expression)
-    return [token for token in tokens if token.strip()]
+    return token_regex.findall(expression)
+
+
+def replace_escape_sequence(match):
+    sequence = match.group(1)
+    if len(sequence) > 1:
+        return chr(int(sequence[1:], 16))  # \xhh, \uXXXX, \UXXXXXXXX
+    # unknown escapes are kept as written
+    return escape_sequences.get(sequence, match.group(0))
 
 
 def unescape_string_literal(s):
     # Replace escape sequences with their corresponding characters
     # Common escape sequences: \n, \t, \", \', \\
-    return s.encode().decode("unicode_escape")
-
-
-def is_iso_date_string(value):
-    return iso_date_regex.match(value) is not None
+    if "\\" not in s:
+        return s
+    return escape_regex.sub(replace_escape_sequence, s)
 
 
+# datetime objects are immutable, so every literal for the same date can share one
+@lru_cache(maxsize=256)
 def parse_iso_date_string(value):
     try:
         return datetime.fromisoformat(value)
@@ -138,24 +115,24 @@ def parse_iso_date_string(value):
 
 # Functions for checking token types
 def is_number(token):
-    return re.match(r"^-?\d+(\.\d+)?$", token) is not None
+    return number_regex.match(token) is not None
 
 
 def is_identifier(token):
     # Identifiers can include dots but cannot start with a dollar sign
-    return re.match(r"^[a-zA-Z_][\w\.]*$", token) is not None and not token.startswith("$")
+    return identifier_regex.match(token) is not None and not token.startswith("$")
 
 
 def is_function(token):
     # Functions start with a dollar sign and can include dots
-    return re.match(r"^\$[a-zA-Z_][\w\.]*$", token) is not None
+    return function_regex.match(token) is not None
 
 
 def is_operator(token):
     if isinstance(token, str):
-        return token in binary_operators or token in unary_operators
+        return token in operator_info
     elif isinstance(token, dict):
-        return is_operator(token.get("name", None))
+        return token.get("name", None) in operator_info
     return False
 
 
@@ -167,31 +144,40 @@ def is_unary_operator(token):
     return token in unary_operators
 
 
-def shunting_yard(tokens):
+# The operator tables are bound as defaults so the token loop reads them as fast locals
+def shunting_yard(tokens, operator_info=operator_info, boolean_literals=boolean_literals, open_brackets=open_brackets):
     output_queue = []
     operator_stack = []
     argument_count = []  # for function args
     element_count = []  # for list elements
+    literals = {}  # repeated literals share one node
+    balance = 0  # open parentheses, checked as tokens arrive
+
+    def literal(token, node_type, value):
+        # keyed by source text: equal values such as 0.0 and -0.0 stay distinct nodes
+        node = literals.get(token)
+        if node is None:
+            node = literals[token] = {"type": node_type, "value": value}
+        return node
 
     for token in tokens:
-        # print(token, operator_stack, output_queue)
+        info = operator_info.get(token)
         if is_number(token):
-            # It's a number
-            try:
-                output_queue.append({"type": "lit", "value": float(token)})
-            except ValueError:
-                output_queue.append({"type": "lit", "value": token})
-        elif (token.startswith('"') and token.endswith('"')) or (token.startswith("'") and token.endswith("'")):
+            # It's a number; integers stay ints
+            output_queue.append(literal(token, "lit", float(token) if "." in token else int(token)))
+        elif token.lower() in boolean_literals:
+            output_queue.append(literal(token, "lit", boolean_literals[token.lower()]))
+        elif len(token) > 1 and (
+            (token.startswith('"') and token.endswith('"')) or (token.startswith("'") and token.endswith("'"))
+        ):
             # It's a string literal with potential escaped characters
             string_value = unescape_string_literal(token[1:-1])  # Remove quotes and unescape
-            output_queue.append({"type": "lit_str", "value": string_value})
+            output_queue.append(literal(token, "lit_str", string_value))
         elif (token.startswith('d"') and token.endswith('"')) or (token.startswith("d'") and token.endswith("'")):
             # It's a date string literal with potential escaped characters
             string_value = unescape_string_literal(token[2:-1])  # Remove quotes and unescape
-            if is_iso_date_string(string_value):
-                output_queue.append({"type": "lit_date", "value": parse_iso_date_string(string_value)})
-
-        elif is_identifier(token) and not (is_function(token) or is_operator(token)):
+            output_queue.append(literal(token, "lit_date", parse_iso_date_string(string_value)))
+        elif info is None and is_identifier(token) and not is_function(token):
             # It's an identifier
             output_queue.append({"type": "id", "value": token})
         elif is_function(token):
@@ -199,7 +185,7 @@ def shunting_yard(tokens):
             operator_stack.append({"type": "fun", "name": token})
         elif token == ",":
             # Argument separator
-            while operator_stack and operator_stack[-1] not in ["(", "["]:
+            while operator_stack and operator_stack[-1] not in open_brackets:
                 output_queue.append(operator_stack.pop())
             if not operator_stack:
                 raise ValueError("Misplaced function argument separator or mismatched parentheses/brackets.")
@@ -212,6 +198,7 @@ def shunting_yard(tokens):
                     element_count[-1] += 1  # +1 for first element
                 element_count[-1] += 1
         elif token == "(":
+            balance += 1
             argument_count.append(0)
             found_fun = False
             if (
@@ -229,13 +216,15 @@ def shunting_yard(tokens):
             operator_stack.append(token)
             element_count.append(0)
         elif token == ")":
-            # print(")", operator_stack, output_queue)
+            balance -= 1
+            if balance < 0:
+                raise ValueError("Unbalanced parentheses: too many closing parentheses")
             while operator_stack and operator_stack[-1] != "(":
                 output_queue.append(operator_stack.pop())
             if not operator_stack:
                 raise ValueError("Mismatched parentheses when unrolling.")
             operator_stack.pop()
-            if operator_stack and operator_stack[-1]["type"] == "fun":
+            if operator_stack and isinstance(operator_stack[-1], dict) and operator_stack[-1]["type"] == "fun":
                 func = operator_stack.pop()
                 args = argument_count.pop()
                 func["args"] = args
@@ -249,25 +238,23 @@ def shunting_yard(tokens):
             operator_stack.pop()
             output_queue.append({"type": "list", "elements": element_count.pop()})
 
-        elif is_operator(token):
-            while (
-                operator_stack
-                and is_operator(operator_stack[-1])
-                and (
-                    (associativity[token] == "L" and get_precedence(token) <= get_stack_precedence(operator_stack))
-                    or (
-                        associativity[token] == "R" and get_precedence(token) < get_stack_precedence(operator_stack)
-                    )
-                )
-            ):
-                output_queue.append(operator_stack.pop())
-            if is_binary_operator(token):
-                operator_stack.append({"type": "bin_op", "name": token})
-            else:
-                operator_stack.append({"type": "unary_op", "name": token})
+        elif info is not None:
+            token_precedence, token_associativity, arity = info
+            while operator_stack and is_operator(operator_stack[-1]):
+                stack_precedence = get_stack_precedence(operator_stack)
+                if token_precedence < stack_precedence or (
+                    token_precedence == stack_precedence and token_associativity == "L"
+                ):
+                    output_queue.append(operator_stack.pop())
+                else:
+                    break
+            operator_stack.append({"type": "bin_op" if arity == 2 else "unary_op", "name": token})
         else:
             raise ValueError("Unknown token: " + token)
 
+    if balance > 0:
+        raise ValueError("Unbalanced parentheses: missing closing parenthesis - " + str(balance))
+
     while operator_stack:
         if operator_stack[-1] == "(":
             raise ValueError("Mismatched parentheses.")
@@ -278,23 +265,11 @@ def shunting_yard(tokens):
     return output_queue
 
 
-def check_parentheses_balance(tokens):
-    balance = 0
-    for token in tokens:
-        if token == "(":
-            balance += 1
-        elif token == ")":
-            balance -= 1
-        if balance < 0:
-            raise ValueError("Unbalanced parentheses: too many closing parentheses")
-    if balance > 0:
-        raise ValueError("Unbalanced parentheses: missing closing parenthesis - " + str(balance))
-
-
+# Parsed trees are cached per expression string. The returned tree is shared
+# between callers and must be treated as read-only.
+@lru_cache(maxsize=1024)
 def parse_to_tree(expression):
-    tokens = tokenize(expression)
-    check_parentheses_balance(tokens)
-    rpn = shunting_yard(tokens)
+    rpn = shunting_yard(tokenize(expression))
     # print(rpn)
 
     def build_tree(rpn_queue):
@@ -4,394 +4,91 @@ from service.term_interpreter import *
 from service.term_parser import parse_to_tree
 
 
-class TestASTEvaluation(unittest.TestCase):
-    def test_evaluation_with_identifiers(self):
-        ast_example_with_identifiers = {
-            "type": "bin_op",
-            "name": "+",
-            "args": [
-                {"type": "id", "value": "x"},
-                {
-                    "type": "bin_op",
-                    "name": "*",
-                    "args": [
-                        {"type": "id", "value": "y"},
-                        {"type": "lit", "value": "2"},
-                    ],
-                },
-            ],
-        }
-        environment = {"x": 3, "y": 4}
-        result = evaluate(ast_example_with_identifiers, environment)
-        self.assertEqual(result, 11)
+def lit(value):
+    return {"type": "lit", "value": value}
 
-    def test_evaluation_without_identifiers(self):
-        ast_example = {
-            "type": "bin_op",
-            "name": "+",
-            "args": [
-                {"type": "lit", "value": "3"},
-                {
-                    "type": "bin_op",
-                    "name": "*",
-                    "args": [
-                        {"type": "lit", "value": "4"},
-                        {"type": "lit", "value": "2"},
-                    ],
-                },
-            ],
-        }
-        result = evaluate(ast_example, {})
-        self.assertEqual(result, 11)
-
-    # Unary ops
-    def test_evaluation_unary_not(self):
-        ast_not = {
-            "type": "unary_op",
-            "name": "not",
-            "args": [
-                {"type": "lit", "value": "1"},
-            ],
-        }
-        result = evaluate(ast_not, {})
-        self.assertEqual(result, False)
 
-    def test_evaluation_unary_not2(self):
-        ast_not = {
-            "type": "unary_op",
-            "name": "not",
-            "args": [
-                {"type": "lit", "value": "0"},
-            ],
-        }
-        result = evaluate(ast_not, {})
-        self.assertEqual(result, True)
+def identifier(name):
+    return {"type": "id", "value": name}
 
-    def test_evaluation_unary_floor(self):
-        ast_floor = {
-            "type": "unary_op",
-            "name": "floor",
-            "args": [
-                {"type": "lit", "value": "3.5"},
-            ],
-        }
-        result = evaluate(ast_floor, {})
-        self.assertEqual(result, 3)
-
-    def test_evaluation_unary_ceil(self):
-        ast_ceil = {
-            "type": "unary_op",
-            "name": "ceil",
-            "args": [
-                {"type": "lit", "value": "3.2"},
-            ],
-        }
-        result = evaluate(ast_ceil, {})
-        self.assertEqual(result, 4)
 
-    # Binary ops
-    def test_evaluation_binary_add(self):
-        ast_add = {
-            "type": "bin_op",
-            "name": "+",
-            "args": [
-                {"type": "lit", "value": "5"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_add, {})
-        self.assertEqual(result, 8)
+def unary_op(name, arg):
+    return {"type": "unary_op", "name": name, "args": [arg]}
 
-    def test_evaluation_binary_subtract(self):
-        ast_subtract = {
-            "type": "bin_op",
-            "name": "-",
-            "args": [
-                {"type": "lit", "value": "5"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_subtract, {})
-        self.assertEqual(result, 2)
 
-    def test_evaluation_binary_multiply(self):
-        ast_multiply = {
-            "type": "bin_op",
-            "name": "*",
-            "args": [
-                {"type": "lit", "value": "5"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_multiply, {})
-        self.assertEqual(result, 15)
+def bin_op(name, left, right):
+    return {"type": "bin_op", "name": name, "args": [left, right]}
 
-    def test_evaluation_binary_divide(self):
-        ast_divide = {
-            "type": "bin_op",
-            "name": "/",
-            "args": [
-                {"type": "lit", "value": "10"},
-                {"type": "lit", "value": "2"},
-            ],
-        }
-        result = evaluate(ast_divide, {})
-        self.assertEqual(result, 5)
-
-    def test_evaluation_binary_modulo(self):
-        ast_modulo = {
-            "type": "bin_op",
-            "name": "mod",
-            "args": [
-                {"type": "lit", "value": "10"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_modulo, {})
-        self.assertEqual(result, 1)
-
-    def test_evaluation_binary_less_than(self):
-        ast_less_than = {
-            "type": "bin_op",
-            "name": "<",
-            "args": [
-                {"type": "lit", "value": "2"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_less_than, {})
-        self.assertTrue(result)
-
-    def test_evaluation_binary_less_than_or_equal(self):
-        ast_less_than_equal = {
-            "type": "bin_op",
-            "name": "<=",
-            "args": [
-                {"type": "lit", "value": "3"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_less_than_equal, {})
-        self.assertTrue(result)
 
-    def test_evaluation_binary_greater_than(self):
-        ast_greater_than = {
-            "type": "bin_op",
-            "name": ">",
-            "args": [
-                {"type": "lit", "value": "4"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_greater_than, {})
-        self.assertTrue(result)
-
-    def test_evaluation_binary_greater_than_or_equal(self):
-        ast_greater_than_equal = {
-            "type": "bin_op",
-            "name": ">=",
-            "args": [
-                {"type": "lit", "value": "3"},
-                {"type": "lit", "value": "2"},
-            ],
-        }
-        result = evaluate(ast_greater_than_equal, {})
-        self.assertTrue(result)
-
-    def test_evaluation_binary_equal(self):
-        ast_equal = {
-            "type": "bin_op",
-            "name": "==",
-            "args": [
-                {"type": "lit", "value": "3"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_equal, {})
-        self.assertTrue(result)
-
-    def test_evaluation_binary_not_equal(self):
-        ast_not_equal = {
-            "type": "bin_op",
-            "name": "!=",
-            "args": [
-                {"type": "lit", "value": "3"},
-                {"type": "lit", "value": "4"},
-            ],
-        }
-        result = evaluate(ast_not_equal, {})
-        self.assertTrue(result)
-
-    def test_evaluation_binary_and(self):
-        ast_and = {
-            "type": "bin_op",
-            "name": "and",
-            "args": [
-                {"type": "lit", "value": "true"},
-                {"type": "lit", "value": "False"},
-            ],
-        }
-        result = evaluate(ast_and, {})
-        self.assertFalse(result)
-
-    def test_evaluation_binary_and2(self):
-        ast_and = {
-            "type": "bin_op",
-            "name": "and",
-            "args": [
-                {"type": "lit", "value": "true"},
-                {"type": "lit", "value": "True"},
-            ],
-        }
-        result = evaluate(ast_and, {})
-        self.assertTrue(result)
-
-    def test_evaluation_binary_or(self):
-        ast_or = {
-            "type": "bin_op",
-            "name": "or",
-            "args": [
-                {"type": "lit", "value": "False"},
-                {"type": "lit", "value": "True"},
-            ],
-        }
-        result = evaluate(ast_or, {})
-        self.assertTrue(result)
+class TestASTEvaluation(unittest.TestCase):
+    def test_evaluation_with_identifiers(self):
+        ast = bin_op("+", identifier("x"), bin_op("*", identifier("y"), lit("2")))
+        self.assertEqual(evaluate(ast, {"x": 3, "y": 4}), 11)
 
-    def test_evaluation_binary_or2(self):
-        ast_or = {
-            "type": "bin_op",
-            "name": "or",
-            "args": [
-                {"type": "lit", "value": "False"},
-                {"type": "lit", "value": "0"},
-            ],
-        }
-        result = evaluate(ast_or, {})
-        self.assertFalse(result)
+    def test_evaluation_without_identifiers(self):
+        self.assertEqual(evaluate(bin_op("+", lit("3"), bin_op("*", lit("4"), lit("2"))), {}), 11)
+
+    def test_evaluation_unary_ops(self):
+        for name, value, expected in [
+            ("not", "1", False),
+            ("not", "0", True),
+            ("floor", "3.5", 3),
+            ("ceil", "3.2", 4),
+        ]:
+            with self.subTest(name=name, value=value):
+                self.assertEqual(evaluate(unary_op(name, lit(value)), {}), expected)
+
+    def test_evaluation_binary_ops(self):
+        for name, left, right, expected in [
+            ("+", "5", "3", 8),
+            ("-", "5", "3", 2),
+            ("*", "5", "3", 15),
+            ("/", "10", "2", 5),
+            ("mod", "10", "3", 1),
+            ("<", "2", "3", True),
+            ("<=", "3", "3", True),
+            (">", "4", "3", True),
+            (">=", "3", "2", True),
+            ("==", "3", "3", True),
+            ("!=", "3", "4", True),
+            ("and", "true", "False", False),
+            ("and", "true", "True", True),
+            ("or", "False", "True", True),
+            ("or", "False", "0", False),
+        ]:
+            with self.subTest(name=name, left=left, right=right):
+                self.assertEqual(evaluate(bin_op(name, lit(left), lit(right)), {}), expected)
 
     # Bonus: Testing op precedence
     def test_evaluation_op_precedence(self):
-        ast_precedence = {
-            "type": "bin_op",
-            "name": "+",
-            "args": [
-                {"type": "lit", "value": "3"},
-                {
-                    "type": "bin_op",
-                    "name": "*",
-                    "args": [
-                        {"type": "lit", "value": "4"},
-                        {"type": "lit", "value": "2"},
-                    ],
-                },
-            ],
-        }
-        result = evaluate(ast_precedence, {})
+        result = evaluate(bin_op("+", lit("3"), bin_op("*", lit("4"), lit("2"))), {})
         self.assertEqual(result, 11)  # Confirms 4 * 2 is evaluated before adding 3
 
     # Edge Cases Tests
     def test_division_by_zero(self):
-        ast_div_zero = {
-            "type": "bin_op",
-            "name": "/",
-            "args": [
-                {"type": "lit", "value": "10"},
-                {"type": "lit", "value": "0"},
-            ],
-        }
         with self.assertRaises(ZeroDivisionError):
-            evaluate(ast_div_zero, {})
+            evaluate(bin_op("/", lit("10"), lit("0")), {})
 
     def test_large_numbers(self):
         large_value = float(10**32)
-        ast_large_numbers = {
-            "type": "bin_op",
-            "name": "+",
-            "args": [
-                {"type": "lit", "value": str(large_value)},
-                {"type": "lit", "value": "1"},
-            ],
-        }
-        result = evaluate(ast_large_numbers, {})
+        result = evaluate(bin_op("+", lit(str(large_value)), lit("1")), {})
         self.assertEqual(result, large_value + 1)
 
     def test_negative_numbers(self):
-        ast_negative_numbers = {
-            "type": "bin_op",
-            "name": "-",
-            "args": [
-                {"type": "lit", "value": "-5"},
-                {"type": "lit", "value": "3"},
-            ],
-        }
-        result = evaluate(ast_negative_numbers, {})
-        self.assertEqual(result, -8)
+        self.assertEqual(evaluate(bin_op("-", lit("-5"), lit("3")), {}), -8)
 
     # Type Checking Tests
     def test_invalid_type_division(self):
-        ast_invalid_type = {
-            "type": "bin_op",
-            "name": "/",
-            "args": [
-                {"type": "lit", "value": "'string'"},
-                {"type": "lit", "value": "2"},
-            ],
-        }
         with self.assertRaises(TypeError):
-            evaluate(ast_invalid_type, {})
+            evaluate(bin_op("/", lit("'string'"), lit("2")), {})
 
     # Complex Expressions Tests
     def test_nested_expressions(self):
-        ast_nested = {
-            "type": "bin_op",
-            "name": "*",
-            "args": [
-                {
-                    "type": "bin_op",
-                    "name": "+",
-                    "args": [
-                        {"type": "lit", "value": "3"},
-                        {"type": "lit", "value": "2"},
-                    ],
-                },
-                {
-                    "type": "bin_op",
-                    "name": "-",
-                    "args": [
-                        {"type": "lit", "value": "5"},
-                        {"type": "lit", "value": "1"},
-                    ],
-                },
-            ],
-        }
-        result = evaluate(ast_nested, {})
+        result = evaluate(bin_op("*", bin_op("+", lit("3"), lit("2")), bin_op("-", lit("5"), lit("1"))), {})
         self.assertEqual(result, (3 + 2) * (5 - 1))
 
     def test_multiple_ops(self):
-        ast_multiple_ops = {
-            "type": "bin_op",
-            "name": "+",
-            "args": [
-                {
-                    "type": "bin_op",
-                    "name": "*",
-                    "args": [
-                        {"type": "lit", "value": "2"},
-                        {"type": "lit", "value": "3"},
-                    ],
-                },
-                {
-                    "type": "bin_op",
-                    "name": "/",
-                    "args": [
-                        {"type": "lit", "value": "10"},
-                        {"type": "lit", "value": "2"},
-                    ],
-                },
-            ],
-        }
-        result = evaluate(ast_multiple_ops, {})
+        result = evaluate(bin_op("+", bin_op("*", lit("2"), lit("3")), bin_op("/", lit("10"), lit("2"))), {})
         self.assertEqual(result, (2 * 3) + (10 / 2))
 
     def test_simple_date_lit_expression(self):
@@ -427,3 +124,180 @@ class TestASTEvaluation(unittest.TestCase):
 
     def test_simple_date_fun(self):
         self.assertEqual(evaluate(parse_to_tree("date.addDays(d'2024-01-01',2) == d'2024-01-03'"), {}), True)
+
+    def test_evaluate_str_lowers_to_compact_nodes(self):
+        node = lower(parse_to_tree("(3 + 4) * x - 5"))
+        self.assertIsInstance(node, BinOp)
+        self.assertIs(node.fn, binary_operators["-"])
+        self.assertEqual(evaluate_str("(3 + 4) * x - 5", {"x": 2}), 9)
+
+    def test_constant_subtrees_are_folded(self):
+        self.assertEqual(lower(parse_to_tree("'abc' == 'def'")), Lit(False))
+        self.assertEqual(lower(parse_to_tree("d'2023-01-01' < d'2023-12-31'")), Lit(True))
+        self.assertEqual(lower(parse_to_tree("'ab' + 'c' == s")).left, Lit("abc"))
+        self.assertIsInstance(lower(parse_to_tree("[1, 2] == [1, 2]")), BinOp)
+
+    def test_numeric_subtrees_are_folded(self):
+        self.assertEqual(lower(parse_to_tree("2 * (3 + 4) - 5")), Lit(9))
+        self.assertEqual(lower(parse_to_tree("(3 + 4) * x")).left, Lit(7))
+        with self.assertRaises(ZeroDivisionError):
+            evaluate_str("1 / 0")
+
+    def test_unbounded_operators_are_not_folded(self):
+        self.assertIsInstance(lower(parse_to_tree("x and 9 ** 9 ** 9")).right, BinOp)
+        self.assertIsInstance(lower(parse_to_tree("1 << 100000 > x")).left, BinOp)
+        self.assertIsInstance(lower(parse_to_tree("'ab' * 100000 == s")).left, BinOp)
+        self.assertEqual(evaluate_str("x and 9 ** 9 ** 9", {"x": 0}), 0)
+        self.assertEqual(lower(parse_to_tree("0 and 9 ** 9 ** 9")), Lit(0))
+        self.assertEqual(lower(parse_to_tree("1 or 9 ** 9 ** 9")), Lit(1))
+
+    def test_builtin_functions_are_bound_when_lowered(self):
+        node = lower(parse_to_tree("str.concat('x', 'yz')"))
+        self.assertIsInstance(node, BuiltinCall)
+        self.assertIs(node.fn, builtin_env["str.concat"])
+        self.assertEqual(evaluate_str("str.concat('x', 'yz')"), "xyz")
+
+    def test_env_shadows_builtin_constants(self):
+        self.assertEqual(evaluate(parse_to_tree("e + 1"), {"e": 1}), 2)
+        self.assertEqual(evaluate(parse_to_tree("e"), {}), math.e)
+        self.assertEqual(evaluate_str("e + 1", {"e": 1}), 2)
+        self.assertEqual(evaluate_str("pi"), math.pi)
+
+    def test_env_does_not_override_builtin_functions(self):
+        env = {"max": lambda a, b: "user", "x": 1, "y": 2}
+        self.assertEqual(evaluate(parse_to_tree("max(x, y)"), env), 2)
+        self.assertEqual(evaluate_str("max(x, y)", env), 2)
+
+    def test_compile_to_bytecode(self):
+        code = compile_ast(parse_to_tree("(3 + 4) * x - 5"))
+        self.assertEqual(
+            code,
+            (
+                (LOAD_CONST, 7),
+                (LOAD_ID, "x"),
+                (BINARY_OP, binary_operators["*"]),
+                (LOAD_CONST, 5),
+                (BINARY_OP, binary_operators["-"]),
+            ),
+        )
+        self.assertEqual(evaluate_str("[1, x] + [str.indexOf('abc', 'c'), 4]", {"x": 2}), [1, 2, 2, 4])
+        with self.assertRaises(NameError):
+            evaluate_str("y + 1")
+
+    def test_and_or_short_circuit(self):
+        calls = []
+
+        def touch(*values):
+            calls.append(values)
+            return values
+
+        env = {"touch": touch, "x": 0, "y": 2}
+        self.assertEqual(evaluate_str("x and touch(1, 1)", env), 0)
+        self.assertEqual(evaluate_str("y or touch(1, 1)", env), 2)
+        self.assertEqual(calls, [])
+        self.assertEqual(evaluate_str("y and touch(1, 1)", env), (1, 1))
+        self.assertEqual(calls, [(1, 1)])
+        self.assertEqual(evaluate_str("y and x or y", env), 2)
+        self.assertEqual(lower(parse_to_tree("true and x")), Id("x"))
+
+    def test_equal_literals_with_different_text_keep_their_values(self):
+        self.assertEqual(evaluate_str("str.concat(0.0, ' ', -0.0)"), "0.0 -0.0")
+        formatted = evaluate_str(
+            "[date.format(d'2023-01-01T00:00:00+00:00', '%H %z'), date.format(d'2023-01-01T01:00:00+01:00', '%H %z')]"
+        )
+        self.assertEqual(formatted, ["00 +0000", "01 +0100"])
+
+    def test_integer_literals_stay_int(self):
+        self.assertIs(type(evaluate_str("3 * 4")), int)
+        self.assertIs(type(evaluate_str("7 // 2")), int)
+        self.assertIs(type(evaluate_str("3.5 * 2")), float)
+        self.assertEqual(evaluate_str("2 ** 64"), 18446744073709551616)
+
+    def test_typed_literal_tags(self):
+        ast = {
+            "type": "bin_op",
+            "name": "+",
+            "args": [{"type": "lit_int", "value": 3}, {"type": "lit_float", "value": 0.5}],
+        }
+        self.assertEqual(evaluate(ast), 3.5)
+        self.assertIs(evaluate({"type": "lit_bool", "value": True}), True)
+
+    def test_compile_ast_from_dict_tree(self):
+        ast = {
+            "type": "bin_op",
+            "name": "+",
+            "args": [{"type": "id", "value": "x"}, {"type": "lit", "value": "2"}],
+        }
+        self.assertEqual(compile_ast(ast), ((LOAD_ID, "x"), (LOAD_CONST, 2), (BINARY_OP, binary_operators["+"])))
+        self.assertEqual(execute(compile_ast(ast), {"x": 3}), 5)
+
+    def test_evaluate_compiles_each_tree_once(self):
+        tree = parse_to_tree("x + 1")
+        self.assertEqual(evaluate(tree, {"x": 1}), 2)
+        self.assertIs(compile_tree(tree), compile_tree(tree))
+        self.assertEqual(evaluate(tree, {"x": 2}), 3)
+        clear_eval_cache()
+        self.assertEqual(compiled_trees, {})
+
+    def test_clear_eval_cache(self):
+        evaluate_str("1 + 2")
+        self.assertGreater(compile_str_to_function.cache_info().currsize, 0)
+        clear_eval_cache()
+        self.assertEqual(compile_str_to_function.cache_info().currsize, 0)
+        self.assertEqual(parse_to_tree.cache_info().currsize, 0)
+        self.assertEqual(evaluate_str("1 + 2"), 3)
+
+    def test_compiled_function_matches_bytecode(self):
+        env = with_builtins({"x": 3, "y": 4, "s": "abc", "f": max})
+        for expression in [
+            "x * 2 + y - 1 > x and y < 10 or x == 3",
+            "[x, y, x + y, x * y]",
+            "str.concat(s, 'd', s) == s",
+            "not x < y",
+            "neg x ** 2",
+            "floor(x / y)",
+            "f(x, y) % 3",
+            "x * pi",
+        ]:
+            node = lower(parse_to_tree(expression))
+            self.assertEqual(compile_to_function(node)(env), execute(compile_to_bytecode(node), env))
+
+    def test_compiled_function_raises_first_error_like_bytecode(self):
+        for expression, env in [
+            ("1 / 0 + x * x", {}),
+            ("y * y + x / 0", {"x": 1}),
+            ("(y and x) + x * x", {"y": 0}),
+            ("f(1 / 0, x)", {}),
+            ("f(x, y) + x", {"y": 1}),
+        ]:
+            node = lower(parse_to_tree(expression))
+            with self.subTest(expression=expression):
+                with self.assertRaises(Exception) as vm_error:
+                    execute(compile_to_bytecode(node), with_builtins(env))
+                with self.assertRaises(Exception) as function_error:
+                    compile_to_function(node)(with_builtins(env))
+                self.assertIs(type(function_error.exception), type(vm_error.exception))
+        with self.assertRaises(ZeroDivisionError):
+            evaluate_str("1 / 0 + x * x")
+
+    def test_compiled_function_errors(self):
+        with self.assertRaises(NameError):
+            evaluate_str("y + 1", {"x": 1})
+        self.assertEqual(evaluate_str("x > 5 and y", {"x": 1}), False)
+        with self.assertRaises(NameError):
+            evaluate_str("z * z", {"x": 1})
+
+    def test_repeated_identifiers_are_read_once(self):
+        reads = []
+
+        class Env(dict):
+            def __getitem__(self, key):
+                reads.append(key)
+                return super().__getitem__(key)
+
+        self.assertEqual(compile_str_to_function("x * x + x - y")(Env(x=3, y=1)), 11)
+        self.assertEqual(sorted(reads), ["x", "y"])
+        # reads that may be short-circuited are not moved ahead
+        self.assertEqual(evaluate_str("x > 5 and y * y", {"x": 1}), False)
+        # too deeply nested for the Python compiler; runs on the VM
+        self.assertEqual(evaluate_str("x" + " + x" * 300, {"x": 1}), 301)
@@ -39,6 +39,11 @@ class TestParserMethods(unittest.TestCase):
         expected_tokens = ["str.concat", "(", "tm1.x", ",", "'x'", ",", "tm2.y", ")"]
         self.assertEqual(tokenize(input_expression), expected_tokens)
 
+    def test_tokenize_keeps_unknown_characters(self):
+        self.assertEqual(tokenize("5 @ 3"), ["5", "@", "3"])
+        with self.assertRaises(ValueError):
+            parse_to_tree("5 @ 3")
+
     def test_shunting_yard_simple_case(self):
         tokens = ["tm1", "and", "tm2"]
         expected_output = [
@@ -84,6 +89,21 @@ class TestParserMethods(unittest.TestCase):
         }
         self.assertEqual(parse_to_tree(expression), expected_tree)
 
+    def test_parse_to_tree_invalid_date_lit(self):
+        with self.assertRaises(ValueError) as context:
+            parse_to_tree("d'2023-13-01' == d'2023-01-01'")
+        self.assertTrue("Invalid ISO date string" in str(context.exception))
+
+    def test_parse_iso_date_string_is_shared(self):
+        left = parse_to_tree("d'2023-01-01' == x")["args"][0]["value"]
+        right = parse_to_tree('x == d"2023-01-01"')["args"][1]["value"]
+        self.assertIs(left, right)
+
+    def test_unescape_string_literal(self):
+        self.assertEqual(unescape_string_literal("café"), "café")
+        self.assertEqual(unescape_string_literal("a\\nb\\t\\'c\\\\"), "a\nb\t'c\\")
+        self.assertEqual(unescape_string_literal("\\x41\\u00e9"), "Aé")
+
     def test_parse_to_tree_simple_list_expression(self):
         expression = "[3, 'x',  4]"
         expected_tree = {
@@ -160,6 +180,17 @@ class TestParserMethods(unittest.TestCase):
             parse_to_tree(expression)
         self.assertTrue("Unbalanced parentheses" in str(context.exception))
 
+    def test_parse_to_tree_unbalanced_nested_parentheses(self):
+        with self.assertRaises(ValueError) as context:
+            parse_to_tree("((1 + 2)")
+        self.assertTrue("missing closing parenthesis - 1" in str(context.exception))
+        with self.assertRaises(ValueError) as context:
+            parse_to_tree("((x)))")
+        self.assertTrue("too many closing parentheses" in str(context.exception))
+
+    def test_parse_to_tree_nested_parentheses(self):
+        self.assertEqual(parse_to_tree("((1))"), {"type": "lit", "value": 1})
+
     def test_parse_to_tree_function_call_with_addition(self):
         expression = "addDays(date, 5) + 10"
         expected_tree = {
@@ -255,6 +286,35 @@ class TestParserMethods(unittest.TestCase):
         }
         self.assertEqual(parse_to_tree(expression), expected_tree)
 
+    def test_parse_to_tree_boolean_literals(self):
+        expected_tree = {
+            "type": "bin_op",
+            "name": "and",
+            "args": [
+                {"type": "lit", "value": 1},
+                {"type": "lit", "value": 0},
+            ],
+        }
+        self.assertEqual(parse_to_tree("true and False"), expected_tree)
+
+    def test_shunting_yard_shares_repeated_literals(self):
+        rpn = shunting_yard(tokenize("5 + 5 == true + 1.0"))
+        self.assertIs(rpn[0], rpn[1])
+        self.assertIsNot(rpn[3], rpn[4])
+
+    def test_equal_literals_with_different_text_stay_distinct(self):
+        self.assertEqual(
+            [str(element["value"]) for element in parse_to_tree("[0.0, -0.0]")["elements"]], ["0.0", "-0.0"]
+        )
+        tree = parse_to_tree("d'2023-01-01T00:00:00+00:00' == d'2023-01-01T01:00:00+01:00'")
+        left, right = tree["args"]
+        self.assertEqual(left["value"], right["value"])
+        self.assertEqual(right["value"].strftime("%H %z"), "01 +0100")
+
+    def test_parse_to_tree_is_cached(self):
+        expression = "2 * (3 + 4) - 5"
+        self.assertIs(parse_to_tree(expression), parse_to_tree(expression))
+
 
 if __name__ == "__main__":
     unittest.main()